@@ -3,10 +3,15 @@
 Definition of classes and import function.
 """
 
-from heapq import nlargest
 import pandas as pd
 import numpy as np
-from utils import format_file, test_score, letter_conversion, inverse_conversion
+from utils import cached_format_file, build_inverse_lookup, CSV_ENGINE
+
+# numba is optional, it is only used to compile handmade grading schemes
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 
 class GradingScheme:
@@ -24,23 +29,89 @@ class GradingScheme:
     _'weights', with arg a dictionary: returns the weighted average,
         with weight of column key being the value arg[key]
     _otherwise, scheme is returned. This can be used to defined a handmade function.
+    A handmade function operating on the whole matrix of grades can be
+    created with from_numba, and is compiled with numba when available.
     """
     def __init__(self, scheme=None, arg=None):
+        self.arg = arg
         if scheme is None or scheme == 'mean':
+            self.kind = 'mean'
             self.scheme = lambda x: x.mean()
         elif scheme == 'drop':
+            self.kind = 'drop'
             def func(grades):
-                nb_grades = len(grades) - arg
-                return sum(nlargest(nb_grades, grades)) / nb_grades
+                kept = np.partition(np.asarray(grades, dtype=np.float64), arg)[arg:]
+                return kept.sum() / kept.size
             self.scheme = func
         elif scheme == 'weights':
+            self.kind = 'weights'
             if isinstance(arg, dict):
-                self.scheme = lambda x: sum([x[key]*value for
-                        (key, value) in arg.items()])/sum(arg.values())
+                self._keys = list(arg.keys())
+                self._weights = np.asarray(list(arg.values()), dtype=np.float64)
+                self._aligned_weights = {}
+                self.scheme = lambda x: x[self._keys].to_numpy(dtype=np.float64) \
+                        @ self._weights / self._weights_sum
             else:
-                self.scheme = lambda x: (x*arg).sum()/sum(arg)
+                self._keys = None
+                self._weights = np.asarray(arg, dtype=np.float64)
+                self.scheme = lambda x: np.asarray(x, dtype=np.float64) \
+                        @ self._weights / self._weights_sum
+            self._weights_sum = self._weights.sum()
         else:
+            self.kind = 'custom'
             self.scheme = scheme
+            self._matrix_func = None
+
+    @classmethod
+    def from_numba(cls, func):
+        """
+        Create a handmade GradingScheme from a function operating on the whole
+        2-D matrix of grades, returning one value per row.
+        The function is compiled with numba when the package is installed.
+        """
+        if njit is not None:
+            func = njit(func)
+        grading_scheme = cls(func)
+        grading_scheme._matrix_func = func
+        return grading_scheme
+
+    def apply_matrix(self, matrix, columns=None):
+        """
+        Apply the scheme to all the rows of a 2-D numpy array at once.
+        columns gives the name of each column of the matrix; it is only needed
+        for a 'weights' scheme defined by a dictionary, and for handmade schemes.
+        Returns a 1-D array containing the result for each row.
+        """
+        if self.kind == 'mean':
+            return matrix.mean(axis=1)
+        if self.kind == 'drop':
+            kept = matrix.shape[1] - self.arg
+            return np.partition(matrix, self.arg, axis=1)[:, self.arg:].sum(axis=1) / kept
+        if self.kind == 'weights':
+            if self._keys is not None:
+                weights = self._weight_vector(columns)
+            else:
+                weights = self._weights
+            return matrix @ weights / self._weights_sum
+        # Matrix-aware handmade scheme (see from_numba): call it on the whole matrix
+        if self._matrix_func is not None:
+            return self._matrix_func(matrix)
+        # Handmade scheme: fall back to a row-by-row application
+        return np.array([self.scheme(pd.Series(row, index=columns)) for row in matrix])
+
+    def _weight_vector(self, columns):
+        """
+        Weight vector of a dictionary scheme aligned to the given columns,
+        built once per column set and reused afterwards.
+        """
+        key = tuple(columns)
+        if key not in self._aligned_weights:
+            missing = [name for name in self._keys if name not in key]
+            if missing:
+                raise Exception('Some weight keys do not match any column:', missing)
+            self._aligned_weights[key] = np.asarray(
+                [self.arg.get(col, 0) for col in columns], dtype=np.float64)
+        return self._aligned_weights[key]
 
 class Test:
     """
@@ -145,6 +216,12 @@ class Assignment:
                                nb_versions=self.nb_versions[i], version_separator=version_separator)
                           for i in range(nb_tests)]
 
+        # Cache the test names, max points, and scaling in the form
+        # used by compute_grades
+        self.test_names = tuple(test.name for test in self.tests)
+        self.max_points_arr = np.asarray(self.max_points, dtype=np.float64)
+        self.scaling = float(self.scaling)
+
 
 class Gradebook:
     """
@@ -179,7 +256,7 @@ class Gradebook:
             used to separate the names (e.g. space ' ' or comma ', ')
         _missing_values: a list of the aliases for missing_values in the csv file
         """
-        self.df = format_file(file, file_type, input_col, info_col,
+        self.df = cached_format_file(file, file_type, input_col, info_col,
                 last_name_first, name_separator, missing_values)
 
 
@@ -238,23 +315,56 @@ class Course:
         # Create gradebook by concatenating the different gradebooks
         # First test for missing grades
         for i, gradebook in enumerate(gradebooks[1:]):
-            difference = set(self.roster.index).difference(set(gradebook.df.index))
-            if difference:
-                print(f'The following students are missing grades in gradebook {i+1}:', difference)
-        # Remove info columns from other gradebooks
-        trimmed_gradebooks = [gradebook.df.loc[:, ~gradebook.df.columns.isin(self.roster.columns)] for gradebook in gradebooks]
-        # Concatenate
-        self.gradebook = pd.concat([self.roster] + trimmed_gradebooks, axis = 1).reindex(self.roster.index)
+            difference = self.roster.index.difference(gradebook.df.index)
+            if not difference.empty:
+                print(f'The following students are missing grades in gradebook {i+1}:',
+                      list(difference))
+        # Join the columns of each gradebook on the roster index,
+        # skipping the columns already present (e.g. the info columns)
+        self.gradebook = self.roster.copy()
+        for gradebook in gradebooks:
+            extra_col = gradebook.df.columns.difference(self.gradebook.columns, sort=False)
+            self.gradebook = self.gradebook.join(gradebook.df[extra_col], how='left')
 
         # Create the grades DataFrame, containing only the grades of the
         # assignments given, and with the different versions combined
 
-        self.grades = self.roster.copy()
-
         self.tests = [test for assignment in assignments for test in assignment.tests]
 
+        # Cache of the final-grade evaluation of each grading scheme,
+        # reused across compute_grades calls
+        self._scheme_cache = {}
+
+        collapsed = []
         for test in self.tests:
-            self.grades[test.name] = self.gradebook.apply(lambda x, test=test: test_score(test.name, x[test.versions], x[info_col['id']]), axis=1)
+            # Collapse all versions of the test into a single column.
+            # Each student should have a grade in at most one version.
+            versions = self.gradebook[test.versions]
+            several_versions = versions.notna().sum(axis=1) > 1
+            if several_versions.any():
+                print(f'Some students have grades in multiple versions of {test.name}:',
+                      list(self.gradebook.loc[several_versions, info_col['id']]))
+            collapsed.append(versions.bfill(axis=1).iloc[:, 0].to_numpy(dtype=np.float64))
+
+        # Store the test grades as a single (student, test) float matrix.
+        # The tests of a given assignment occupy a contiguous range of columns.
+        self._grade_matrix = np.column_stack(collapsed)
+        self._test_index = {test.name: i for (i, test) in enumerate(self.tests)}
+        self._assignment_slices = {}
+        start = 0
+        for assignment in assignments:
+            self._assignment_slices[assignment.name] = slice(start, start + assignment.nb_tests)
+            start += assignment.nb_tests
+
+    @property
+    def grades(self):
+        """
+        DataFrame containing the roster and the grades of all the tests,
+        rebuilt on demand from the grade matrix.
+        """
+        test_grades = pd.DataFrame(self._grade_matrix, index=self.roster.index,
+                                   columns=[test.name for test in self.tests])
+        return pd.concat([self.roster, test_grades], axis=1)
 
     def compute_grades(self, grading_scheme=None, thresholds=None, letters=None,
         include=None, include_others=None):
@@ -319,42 +429,62 @@ class Course:
 
         # Create a df containg the number of missed assignments.
 
+        all_test_names = [test.name for test in self.tests]
+
         if 'missed' in include:
-            for assignment in self.assignments:
-                test_names = [test.name for test in assignment.tests]
-                dfs['missed'][assignment.name + ' missed'] = self.grades[test_names].isna().sum(axis=1)
+            mask = np.isnan(self._grade_matrix).astype(np.int64)
+            # Column offset at which each assignment starts, to sum the mask per assignment
+            starts = [self._assignment_slices[assignment.name].start
+                      for assignment in self.assignments]
+            dfs['missed'] = pd.DataFrame(np.add.reduceat(mask, starts, axis=1),
+                    index=self.roster.index,
+                    columns=[assignment.name + ' missed' for assignment in self.assignments])
 
-        # Then replace missing assignments by 0.
+        # Then replace missing assignments by 0, in a single numpy matrix
+        # containing the grades of all the tests.
 
-        grades = self.grades.copy()
-        grades.replace(np.nan, 0, inplace=True)
+        grade_matrix = np.nan_to_num(self._grade_matrix, copy=True, nan=0.0)
 
         # Create a df containing the tests results
 
         if 'tests' in include:
-            test_col = [test.name for test in self.tests]
-            dfs['tests'] = self.grades[test_col]
+            dfs['tests'] = pd.DataFrame(self._grade_matrix, index=self.roster.index,
+                                        columns=all_test_names)
 
         # Create a df containg the averages
 
         if 'averages' in include or 'final' in include or 'letter' in include:
             unscaled_averages = pd.DataFrame(index=self.roster.index)
             for assignment in self.assignments:
-                test_names = [test.name for test in assignment.tests]
-                dfs['averages'][assignment.name] = grades.apply(lambda x, test_names=test_names, assignment=assignment:
-                                    max(gs.scheme(x[test_names]/assignment.max_points) for gs in assignment.grading_scheme)\
-                                    *assignment.scaling, axis=1)
+                matrix = grade_matrix[:, self._assignment_slices[assignment.name]] \
+                        / assignment.max_points_arr
+                average = np.max([gs.apply_matrix(matrix, assignment.test_names)
+                                  for gs in assignment.grading_scheme], axis=0)
+                dfs['averages'][assignment.name] = pd.Series(average*assignment.scaling,
+                                                             index=self.roster.index)
                 unscaled_averages[assignment.name] = dfs['averages'][assignment.name]/assignment.scaling
 
         # Create a df containg the final grade
 
         if 'final' in include or 'letter' in include:
-            dfs['final']['Final grade'] = unscaled_averages.apply(lambda x: max(gs.scheme(x) for gs in grading_scheme)*100, axis=1)
+            assignment_names = list(unscaled_averages.columns)
+            averages_matrix = unscaled_averages.to_numpy(dtype=np.float64)
+            # The averages only depend on the Course, so the evaluation of each
+            # scheme can be cached and reused across compute_grades calls
+            results = []
+            for gs in grading_scheme:
+                if gs not in self._scheme_cache:
+                    self._scheme_cache[gs] = gs.apply_matrix(averages_matrix, assignment_names)
+                results.append(self._scheme_cache[gs])
+            dfs['final']['Final grade'] = np.maximum.reduce(results)*100
 
         # Create a df containg the letter grades
 
         if 'letter' in include:
-            dfs['letter']['Letter grade'] = dfs['final'].apply(lambda x: letter_conversion(x['Final grade'], thresholds, letters), axis=1)
+            # Negate so that searchsorted sees the thresholds in increasing order
+            indices = np.searchsorted(-np.asarray(thresholds, dtype=np.float64),
+                                      -dfs['final']['Final grade'].to_numpy(dtype=np.float64))
+            dfs['letter']['Letter grade'] = np.asarray(letters)[indices]
 
         # Create a df containing the rest of the columns
         if include_others is not None:
@@ -363,7 +493,8 @@ class Course:
 
         # Crete the df to return
 
-        df = pd.concat([self.roster] + [df for df in dfs.values()], axis = 1).reindex(self.roster.index)
+        # Every df is already indexed by the roster, no reindex needed
+        df = pd.concat([self.roster] + [df for df in dfs.values()], axis=1)
 
         return df
 
@@ -402,7 +533,7 @@ def create_import(input_path, output_path, info_col=None, letter_grade_col='Lett
     if letters is None:
         letters = ['A', 'A-', 'B+', 'B', 'B-', 'C+', 'C', 'D', 'F']
 
-    df = pd.read_csv(input_path)
+    df = pd.read_csv(input_path, engine=CSV_ENGINE)
     username = 'Username'
     final_grade_num = 'Adjusted Final Grade Numerator'
     final_grade_denom = 'Adjusted Final Grade Denominator'
@@ -417,12 +548,12 @@ def create_import(input_path, output_path, info_col=None, letter_grade_col='Lett
 
     output = pd.DataFrame(index=df.index, columns=columns)
 
-    output[username] = df.apply(lambda x: '#' + x[info_col['id']], axis=1)
-    output[info_col_names] = df[info_col_names]
+    output[username] = '#' + df[info_col['id']].astype(str)
+    output[info_col_names] = df[info_col_names].to_numpy()
     for col in include_others:
-        output[col + pg_col] = df[col]
+        output[col + pg_col] = df[col].to_numpy()
     if standardize:
-        output[final_grade_num] = df.apply(lambda x: inverse_conversion(x[letter_grade_col], thresholds=thresholds, letters=letters), axis=1)
+        output[final_grade_num] = df[letter_grade_col].map(build_inverse_lookup(thresholds, letters))
     else:
         output[final_grade_num] = df['Final grade']
     output[final_grade_denom] = 100
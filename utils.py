@@ -2,9 +2,19 @@
 Utility files for the easygrader module.
 """
 
+import os
+from functools import lru_cache
+
 import pandas as pd
 import numpy as np
 
+# The pyarrow csv engine parses in parallel, use it when available
+try:
+    import pyarrow
+    CSV_ENGINE = 'pyarrow'
+except ImportError:
+    CSV_ENGINE = 'c'
+
 def format_file(file, file_type=None, input_col=None, info_col=None,
                 last_name_first=None, name_separator=None, missing_values=None):
     """
@@ -33,14 +43,11 @@ def format_file(file, file_type=None, input_col=None, info_col=None,
         name_separator = ', '
         missing_values = ['ND', 'NS']
 
-    # Read the csv file as DataFrame
-    file_as_df = pd.read_csv(file)
+    # Read the csv file as DataFrame, treating the missing-value aliases as NaN
+    file_as_df = pd.read_csv(file, na_values=missing_values, engine=CSV_ENGINE)
 
-    # Create the new DataFrame and replace all the missing values by np.nan
+    # Create the new DataFrame
     df = pd.DataFrame(index=file_as_df.index)
-    df.fillna(np.nan, inplace=True)
-    if missing_values is not None:
-        df.replace(missing_values, np.nan, inplace=True)
 
     # Deal with names
     if 'first' in input_col.keys() and 'last' in input_col.keys():
@@ -65,9 +72,9 @@ def format_file(file, file_type=None, input_col=None, info_col=None,
         email_col = info_col['email']
         df[email_col] = file_as_df[input_col['email']]
         if 'id' in input_col.keys() and any(df[id_col].isna()):
-            df.loc[df[id_col].isna(), id_col] = df.loc[df[id_col].isna(), email_col].str.split('@', expand=True)[0]
+            df.loc[df[id_col].isna(), id_col] = df.loc[df[id_col].isna(), email_col].str.split('@', n=1).str[0]
         else:
-            df[id_col] = df[email_col].str.split('@', expand=True)[0]
+            df[id_col] = df[email_col].str.split('@', n=1).str[0]
     elif 'id' not in input_col.keys() and 'email' not in input_col.keys():
         raise Exception('An ID column or an email column must be provided.')
 
@@ -75,10 +82,11 @@ def format_file(file, file_type=None, input_col=None, info_col=None,
         raise Exception('Some students do not have an ID nor an email:',
                         df[[info_col['first'], info_col['last']]][df[id_col].isna()].values)
 
-    # Check for duplicate ID
-    duplicates = df[id_col][df[id_col].duplicated()]
-    if duplicates.shape[0] > 0:
-        raise Exception('Some IDs are duplicated:', duplicates)
+    # Check for duplicate ID, in a single pass over the IDs
+    codes, unique_ids = pd.factorize(df[id_col].to_numpy())
+    counts = np.bincount(codes)
+    if (counts > 1).any():
+        raise Exception('Some IDs are duplicated:', unique_ids[counts > 1])
 
     # Add other columns
     other_cols = [col for col in file_as_df.columns if col not in input_col.values()]
@@ -90,18 +98,6 @@ def format_file(file, file_type=None, input_col=None, info_col=None,
     return df
 
 
-def test_score(test_name, results, student_id):
-    """
-    Return the score of the test, given the scores all tests versions.
-    """
-    not_na = [result for result in results if not np.isnan(result)]
-    if not not_na:
-        return np.nan
-    if len(not_na) > 1:
-        print(f'A student has grades in multiple versions of {test_name}: {student_id}')
-    return not_na[0]
-
-
 def letter_conversion(x, thresholds, letters):
     """
     Converts a score in letter grade, given the thresholds and the letters.
@@ -112,11 +108,53 @@ def letter_conversion(x, thresholds, letters):
     return letters[-1]
 
 
+def cached_format_file(file, file_type=None, input_col=None, info_col=None,
+                       last_name_first=None, name_separator=None, missing_values=None):
+    """
+    Version of format_file that caches the result, keyed by the file path and
+    its modification time, so that re-running a grading pipeline does not
+    re-parse unchanged csv files. Returns a copy of the cached DataFrame.
+    """
+    try:
+        mtime = os.path.getmtime(file)
+    except (TypeError, OSError):
+        # Not a path on disk (e.g. a buffer), read it directly
+        return format_file(file, file_type, input_col, info_col,
+                           last_name_first, name_separator, missing_values)
+    return _cached_format_file(
+            str(file), mtime, file_type,
+            tuple(input_col.items()) if input_col is not None else None,
+            tuple(info_col.items()) if info_col is not None else None,
+            last_name_first, name_separator,
+            tuple(missing_values) if missing_values is not None else None).copy()
+
+
+@lru_cache(maxsize=32)
+def _cached_format_file(file, mtime, file_type, input_col, info_col,
+                        last_name_first, name_separator, missing_values):
+    """
+    Cached call to format_file. The dictionary and list parameters are
+    passed as tuples so that the arguments can be hashed.
+    """
+    return format_file(file, file_type,
+                       dict(input_col) if input_col is not None else None,
+                       dict(info_col) if info_col is not None else None,
+                       last_name_first, name_separator,
+                       list(missing_values) if missing_values is not None else None)
+
+
+def build_inverse_lookup(thresholds, letters):
+    """
+    Build a dictionary mapping each letter grade to a normalized score,
+    given the thresholds and the letters.
+    Normalized score = middle of threshold before and after
+    """
+    extended = [100] + list(thresholds) + [0]
+    return {letter: (extended[i] + extended[i+1])//2 for (i, letter) in enumerate(letters)}
+
+
 def inverse_conversion(x, thresholds, letters):
     """
     Converts a letter grade to a normalized score, given the thresholds and the letters.
-    Normalized score = middle of threshold before and after
     """
-    thresholds.extend([0, 100])
-    index = letters.index(x)
-    return (thresholds[index] + thresholds[index-1])//2
+    return build_inverse_lookup(thresholds, letters)[x]